@@ -3,14 +3,18 @@
 # SPDX-License-Identifier: Apache-2.0
 #
 
-import base64
+import binascii
+import contextlib
+import fcntl
 import libvirt
-import shutil
 import grpc
 import hashlib
+import importlib.metadata
+import json
+import os
 import sys
-from uuid import UUID
-from bs4 import BeautifulSoup as bs
+import threading
+from xml.etree import ElementTree
 from sevsnpmeasure import guest
 from sevsnpmeasure.sev_mode import SevMode
 
@@ -18,37 +22,55 @@ from keybroker_pb2_grpc import KeyBrokerServiceStub
 from keybroker_pb2 import BundleRequest, SecretRequest, RequestDetails
 
 XML_PATH = "sev_guest.xml"
+CERT_CHAIN_PATH = "certchain"
 KBS_URI = "127.0.0.1:44444"
+DIGEST_CACHE_PATH = os.path.expanduser("~/.cache/simple-kbs/digests.json")
+DIGEST_CACHE_SIZE = 32
+
+# launch parameters used for the expected digest
+SEV_MODE = SevMode.SEV
+VCPUS = 1
 
 def main():
+    channel = grpc.insecure_channel(KBS_URI)
+    client = KeyBrokerServiceStub(channel)
+
+    # fail early if the KBS cannot be reached
+    try:
+        grpc.channel_ready_future(channel).result(timeout = 5)
+    except grpc.FutureTimeoutError:
+        print("Failed to connect to KBS at {}".format(KBS_URI), file=sys.stderr)
+        channel.close()
+        exit(1)
+
     hv = libvirt.open("qemu:///system")
 
     # load and parse XML
-    f = open(XML_PATH, "r")
-    xml = f.read()
-    f.close()
+    domain = load_domain_xml(XML_PATH)
+
+    # collect the tags we need in a single walk of the document
+    wanted = {"policy", "loader", "initrd", "kernel", "cmdline", "launchSecurity"}
+    found = {}
+    for tag in domain.iter():
+        if tag.tag in wanted:
+            found.setdefault(tag.tag, tag)
 
-    soup = bs(xml, "xml")
-    
-    policy = soup.find("policy").text
+    policy = found["policy"].text
 
     # use this to calculate the expected digest
-    ovmf_path = soup.find("loader").text
-    initrd_path = soup.find("initrd").text
-    kernel_path = soup.find("kernel").text
-    cmdline = soup.find("cmdline").text
+    ovmf_path = found["loader"].text
+    initrd_path = found["initrd"].text
+    kernel_path = found["kernel"].text
+    cmdline = found["cmdline"].text
+
+    # the expected digest only depends on the files above, so hash them
+    # while the launch bundle is fetched and the guest is started
+    expected_digest = ExpectedDigest(ovmf_path, initrd_path, kernel_path, cmdline)
 
-    channel = grpc.insecure_channel(KBS_URI)
-    client = KeyBrokerServiceStub(channel)
-   
-    
     # currrently libvirt cannot export a cert chain with a 
     # signed CEK. instead, use sevctl to export the cert chain
     # and store it in a file.
-    f = open("certchain","rb")
-    cert_chain_bytes = f.read()
-    f.close()
-    cert_chain = base64.b64encode(cert_chain_bytes).decode("utf-8")
+    cert_chain = get_cert_chain(CERT_CHAIN_PATH)
 
     request = BundleRequest(CertificateChain = cert_chain, Policy = int(policy, 0))
     try:
@@ -59,16 +81,14 @@ def main():
         exit(1)
 
     # add godh and session file to XML
-    ls = soup.find("launchSecurity")
-    cert_tag = soup.new_tag("dhCert")
-    cert_tag.string = response.GuestOwnerPublicKey
-    ls.append(cert_tag)
+    ls = found["launchSecurity"]
+    cert_tag = ElementTree.SubElement(ls, "dhCert")
+    cert_tag.text = response.GuestOwnerPublicKey
 
-    session_tag = soup.new_tag("session")
-    session_tag.string = response.LaunchBlob
-    ls.append(session_tag)
+    session_tag = ElementTree.SubElement(ls, "session")
+    session_tag.text = response.LaunchBlob
 
-    xml = str(soup.domain)
+    xml = ElementTree.tostring(domain, encoding="unicode")
 
     # define the domain from XML
     dom = hv.defineXML(xml) 
@@ -77,15 +97,13 @@ def main():
     # get launch measurement
     sevinfo = dom.launchSecurityInfo()
 
-    expected_digest = get_expected_digest(ovmf_path, initrd_path, kernel_path, cmdline)
-
     request = SecretRequest(LaunchMeasurement = sevinfo['sev-measurement'], \
             LaunchId = response.LaunchId, \
             Policy = sevinfo['sev-policy'], \
             ApiMajor = sevinfo['sev-api-major'], \
             ApiMinor = sevinfo['sev-api-minor'], \
             BuildId = sevinfo['sev-build-id'], \
-            FwDigest = expected_digest, \
+            FwDigest = expected_digest.result(), \
             LaunchDescription = "test launch",
             SecretRequests = [\
                     RequestDetails(Guid = "0a46e24d-478c-4eb1-8696-113eeec3aa99", \
@@ -101,6 +119,7 @@ def main():
         channel.close()
         exit(1)
 
+    channel.close()
 
     params = {"sev-secret": response.LaunchSecretData,
               "sev-secret-header": response.LaunchSecretHeader}
@@ -109,14 +128,127 @@ def main():
 
     hv.close()
 
+# run get_expected_digest in the background
+# the worker is a daemon thread so that exiting
+# on an error does not wait for the hashing
+class ExpectedDigest:
+    def __init__(self, ovmf, initrd, kernel, cmdline):
+        self.digest = None
+        self.error = None
+        self.thread = threading.Thread(target = self.run, \
+                args = (ovmf, initrd, kernel, cmdline), daemon = True)
+        self.thread.start()
+
+    def run(self, ovmf, initrd, kernel, cmdline):
+        try:
+            self.digest = get_expected_digest(ovmf, initrd, kernel, cmdline)
+        except Exception as e:
+            self.error = e
+
+    # wait for the digest, re-raising any error from the worker
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.digest
+
+# parse the domain XML so that it can be written back
+# the way libvirt documents it: the namespace prefixes
+# of the file (e.g. xmlns:qemu) are registered so they
+# are not renamed to ns0, and comments are kept
+def load_domain_xml(path):
+    for event, (prefix, uri) in ElementTree.iterparse(path, events = ("start-ns",)):
+        ElementTree.register_namespace(prefix, uri)
+
+    parser = ElementTree.XMLParser(target = ElementTree.TreeBuilder(insert_comments = True))
+    return ElementTree.parse(path, parser).getroot()
+
+# load the base64 encoded cert chain
+def get_cert_chain(path):
+    with open(path, "rb") as f:
+        return binascii.b2a_base64(f.read(), newline=False).decode("ascii")
+
 # calculate the expected launch digest
 # this will be verified via the measurement
 # so it's fine for the CSP to calculate
 # this here
-def get_expected_digest(ovmf, initrd, kernel, cmdline):
-    ld = guest.calc_launch_digest(SevMode.SEV, 1, None, ovmf, kernel, initrd, cmdline)
-    return base64.b64encode(ld).decode("utf-8")
+def calc_expected_digest(ovmf, initrd, kernel, cmdline):
+    ld = guest.calc_launch_digest(SEV_MODE, VCPUS, None, ovmf, kernel, initrd, cmdline)
+    return binascii.b2a_base64(ld, newline=False).decode("ascii")
 
+# the digest only changes when one of the images,
+# the cmdline or sev-snp-measure changes, so results
+# are cached on disk and shared between launches
+#
+# the cache is best-effort: if it cannot be used
+# the digest is calculated directly
+def get_expected_digest(ovmf, initrd, kernel, cmdline):
+    try:
+        key = digest_cache_key(ovmf, initrd, kernel, cmdline)
+        os.makedirs(os.path.dirname(DIGEST_CACHE_PATH), exist_ok=True)
+        with lock_digest_cache():
+            digest = load_digest_cache().get(key)
+    except (OSError, importlib.metadata.PackageNotFoundError) as e:
+        print("Launch digest cache unavailable: {}".format(e), file=sys.stderr)
+        return calc_expected_digest(ovmf, initrd, kernel, cmdline)
+
+    # anything but a string is a corrupt entry, treat it as a miss
+    if isinstance(digest, str):
+        return digest
+
+    # hash without holding the lock so that launches
+    # of different images are not serialized
+    digest = calc_expected_digest(ovmf, initrd, kernel, cmdline)
+
+    # reload so that entries stored by other launches
+    # in the meantime are kept
+    try:
+        with lock_digest_cache():
+            cache = load_digest_cache()
+            cache.pop(key, None)
+            cache[key] = digest
+
+            # drop the oldest entries so the cache does not
+            # grow with every image update
+            while len(cache) > DIGEST_CACHE_SIZE:
+                del cache[next(iter(cache))]
+
+            store_digest_cache(cache)
+    except OSError as e:
+        print("Failed to store launch digest: {}".format(e), file=sys.stderr)
+
+    return digest
+
+def digest_cache_key(ovmf, initrd, kernel, cmdline):
+    params = [importlib.metadata.version("sev-snp-measure"), str(SEV_MODE), VCPUS]
+    for path in (ovmf, kernel, initrd):
+        st = os.stat(path)
+        # ctime and the inode also change when an image is replaced
+        # with content of the same size and a preserved mtime
+        params.append((path, st.st_dev, st.st_ino, st.st_size, \
+                st.st_mtime_ns, st.st_ctime_ns))
+    params.append(cmdline)
+    return hashlib.sha256(repr(params).encode("utf-8")).hexdigest()
+
+@contextlib.contextmanager
+def lock_digest_cache():
+    with open(DIGEST_CACHE_PATH + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def load_digest_cache():
+    try:
+        with open(DIGEST_CACHE_PATH, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def store_digest_cache(cache):
+    tmp_path = DIGEST_CACHE_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, DIGEST_CACHE_PATH)
 
 if __name__ == "__main__":
     main()